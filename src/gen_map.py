@@ -1,10 +1,17 @@
 import logging
 import xarray
+import numpy
+import matplotlib
+matplotlib.use('Agg')  # Maps are only saved to file, so no GUI backend is needed
 import cartopy
 from matplotlib.font_manager import FontProperties
+from matplotlib.colors import ListedColormap, BoundaryNorm
 from matplotlib import pyplot
 from cartopy.io import shapereader
+from cartopy.feature import ShapelyFeature
+import fiona
 import warnings
+import functools
 import argparse
 from datetime import datetime
 
@@ -12,6 +19,18 @@ from datetime import datetime
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
 
+# Levels are used to decide the threshold for each colour level (currently 3 levels per month, see the colourbar in the
+# result)
+LEVELS = numpy.array([30, 40, 50, 61, 71, 81, 91, 101, 111, 122, 132, 142, 153, 163, 173, 181])
+# The first and last colours are for green dates below and above the levels
+COLOURS = ['#374a9f', '#3967a3', '#4575b3', '#659bc8', '#8abeda', '#acdae9', '#cfebf3', '#ebf7e4', '#fffebe', '#fee99d',
+           '#feca7c', '#fca85e', '#f67a49', '#e54f35', '#d02a27', '#b10b26', '#999999']
+# The colour map and norm are built once, instead of by matplotlib every time a map is drawn
+COLOUR_MAP = ListedColormap(COLOURS[1:-1])
+COLOUR_MAP.set_under(COLOURS[0])
+COLOUR_MAP.set_over(COLOURS[-1])
+COLOUR_NORM = BoundaryNorm(LEVELS, COLOUR_MAP.N)
+
 
 def main():
     # Get command line arguments
@@ -36,7 +55,7 @@ def get_options():
     Gets command line arguments and returns them.
     Options are accessed via options.verbose, etc.
 
-    Optional arguments: verbose (v), title
+    Optional arguments: verbose (v), dpi, title
 
     Run this with the -h (help) argument for more detailed information. (python gen_map.py -h)
 
@@ -60,6 +79,12 @@ def get_options():
         help='The path to save the resulting map at.',
         default='results/green_date.png'
     )
+    parser.add_argument(
+        '--dpi',
+        help='The resolution of the map in dots per inch. Defaults to 200.',
+        default=200,
+        type=int
+    )
     parser.add_argument(
         '--title',
         help='The title of the map produced. Defaults to no title.',
@@ -69,66 +94,52 @@ def get_options():
     return args
 
 
-def gen_map(options):
+def gen_map(options, data=None):
     """
     Converts the results from netCDF to a png image.
 
     :param options:
+    :param data: Green Date results already in memory, such as those returned by calc_green_date() in main.py. If not
+                 provided, they are opened from options.green_date
     :return:
     """
-    data = xarray.open_dataset(options.green_date)
+    if data is None:
+        data = xarray.open_dataset(options.green_date)
+    # Results combined with soil types use 'green_date', while results straight from main.py use 'green_dates'
+    green_date = data['green_date'] if 'green_date' in data else data['green_dates']
     projection = cartopy.crs.PlateCarree()
     left, right, bottom, top = 112, 154, -28, -10
     TITLE_FONT = FontProperties(fname='fonts/Roboto-Light.ttf', size=12)
-    colours = ['#374a9f', '#3967a3', '#4575b3', '#659bc8', '#8abeda', '#acdae9', '#cfebf3', '#ebf7e4', '#fffebe',
-               '#fee99d', '#feca7c', '#fca85e', '#f67a49', '#e54f35', '#d02a27', '#b10b26', '#999999']
 
     figure = pyplot.figure(figsize=(8, 8))  # Set size of the plot
     # Create axis for the plot using the desired projection and extent
     ax = pyplot.axes(projection=projection, extent=(left, right, bottom, top+2))
     pyplot.gca().outline_patch.set_visible(False)  # Remove border around plot
 
-    # Get the shape reader
-    shape = shapereader.Reader('shapes/gadm36_AUS_1.shp')
-
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', category=RuntimeWarning)
-        # Plot data as a contour. Levels are used to decide the threshold for each contour level (currently 3 levels
-        # per month, see the colourbar in the result)
-        levels = [30, 40, 50, 61, 71, 81, 91, 101, 111, 122, 132, 142, 153, 163, 173, 181]
-        im = ax.contourf(data['longitude'], data['latitude'], data['green_date'], extend='both',
-                         transform=cartopy.crs.PlateCarree(), levels=levels, colors=colours, zorder=1)
+        # Plot each cell of data in the colour of its level. This is much quicker than building contours, and looks
+        # the same at the resolution of the data.
+        im = ax.pcolormesh(data['longitude'], data['latitude'], green_date, shading='auto',
+                           transform=cartopy.crs.PlateCarree(), cmap=COLOUR_MAP, norm=COLOUR_NORM, zorder=1)
 
     # Draw borders
-    for state in shape.records():
-        ax.add_geometries([state.geometry], cartopy.crs.PlateCarree(), edgecolor='black', facecolor='none',
-                          linewidth=0.4, zorder=3)
+    states = ShapelyFeature(load_state_geometries('shapes/gadm36_AUS_1.shp'), cartopy.crs.PlateCarree(),
+                            edgecolor='black', facecolor='none', linewidth=0.4)
+    ax.add_feature(states, zorder=3)
 
     # Add towns
-    shape_fn = shapereader.natural_earth(resolution='10m', category='cultural', name='populated_places')
-    towns = []
-    featurecla = ['Admin-0 capital', 'Admin-0 capital alt', 'Admin-0 region capital', 'Admin-1 region capital']
-    skip_towns = ['Cloncurry', 'Roebourne', 'McMinns Lagoon', 'Barcaldine', 'Charleville', 'Sunshine Coast', 'Dalby',
-                  'Port Douglas', 'Atherton', 'Innisfail', 'Ingham', 'Ayr', 'Charters Towers', 'Proserpine', 'Emerald',
-                  'Yeppoon', 'Gladstone', 'Biloela', 'Hervey Bay', 'Maryborough', 'Kingaroy', 'Toowoomba', 'Caloundra',
-                  'Bowen', 'Caboolture', 'Bongaree', 'Gympie', 'Moranbah']
-    for record in shapereader.Reader(shape_fn).records():
-        if record.attributes['ADM0NAME'] == 'Australia' and record.geometry.coords[0][1] > -28 \
-                and (record.attributes['POP_MAX'] > 1000 or record.attributes['FEATURECLA'] in featurecla) \
-                and not record.attributes['NAME'] in skip_towns:
-            towns.append({
-                'name': record.attributes['NAME'],
-                'x': record.geometry.coords[0][0],
-                'y': record.geometry.coords[0][1]
-            })
+    towns = load_towns((left, bottom, right, top+2))
+    # All markers are drawn as a single collection (s is the marker area, so a size 3 marker is 9)
+    town_x = numpy.fromiter((town['x'] for town in towns), dtype=float, count=len(towns))
+    town_y = numpy.fromiter((town['y'] for town in towns), dtype=float, count=len(towns))
+    ax.scatter(town_x, town_y, marker='o', facecolor='white', edgecolor='black', linewidths=1, s=9, zorder=4)
     for town in towns:
-        ax.plot('x', 'y', data=town, marker='o', markerfacecolor='white', markeredgewidth=1, markeredgecolor='black',
-                markersize=3, zorder=4)
         ax.text(town['x']+.3, town['y'], town['name'], va='center', ha='left', fontsize='x-small')
 
     # Add a colourbar
     colourbar_axis = figure.add_axes([0.21, 0.25, .6, .02])
-    colourbar = figure.colorbar(im, cax=colourbar_axis, extendfrac=.05, orientation='horizontal')
+    colourbar = figure.colorbar(im, cax=colourbar_axis, extend='both', extendfrac=.05, orientation='horizontal')
     date_ticklabels = ['1 Oct', '1 Nov', '1 Dec', '1 Jan', '1 Feb', '1 Mar']
     colourbar.set_ticks([30, 61, 91, 122, 153, 181])
     colourbar.set_ticklabels(date_ticklabels)
@@ -139,9 +150,55 @@ def gen_map(options):
     pyplot.text(.3, 1, options.title, transform=ax.transAxes, fontproperties=TITLE_FONT)
 
     # Save map
-    pyplot.savefig(options.output, dpi=400, bbox_inches='tight', pil_kwargs={'quality': 80})
+    # Work out the tight bounding box from the layout of the figure, so it doesn't need to be drawn an extra time
+    bbox = figure.get_tightbbox(figure.canvas.get_renderer()).padded(0.1)
+    pyplot.savefig(options.output, dpi=options.dpi, bbox_inches=bbox, pil_kwargs={'quality': 80})
     pyplot.close()
 
 
+@functools.lru_cache(maxsize=None)
+def load_state_geometries(path):
+    """
+    Reads the state borders from a shapefile. The result is cached so the shapefile is only read once.
+
+    :param path: The path of the shapefile containing the state borders
+    :return: Tuple of state geometries
+    """
+    return tuple(shapereader.Reader(path).geometries())
+
+
+@functools.lru_cache(maxsize=None)
+def load_towns(bbox):
+    """
+    Reads the towns to be shown on the map from Natural Earth's populated places. Only records inside the bounding box
+    are read, and the result is cached so the shapefile is only read once.
+
+    :param bbox: Tuple of (left, bottom, right, top) for the area shown on the map
+    :return: Tuple of towns, each a dict with the name, x and y of the town
+    """
+    shape_fn = shapereader.natural_earth(resolution='10m', category='cultural', name='populated_places')
+    towns = []
+    featurecla = frozenset(['Admin-0 capital', 'Admin-0 capital alt', 'Admin-0 region capital',
+                            'Admin-1 region capital'])
+    skip_towns = frozenset(['Cloncurry', 'Roebourne', 'McMinns Lagoon', 'Barcaldine', 'Charleville', 'Sunshine Coast',
+                            'Dalby', 'Port Douglas', 'Atherton', 'Innisfail', 'Ingham', 'Ayr', 'Charters Towers',
+                            'Proserpine', 'Emerald', 'Yeppoon', 'Gladstone', 'Biloela', 'Hervey Bay', 'Maryborough',
+                            'Kingaroy', 'Toowoomba', 'Caloundra', 'Bowen', 'Caboolture', 'Bongaree', 'Gympie',
+                            'Moranbah'])
+    with fiona.open(shape_fn) as source:
+        for record in source.filter(bbox=bbox):
+            attributes = record['properties']
+            if attributes['ADM0NAME'] == 'Australia' \
+                    and (attributes['POP_MAX'] > 1000 or attributes['FEATURECLA'] in featurecla) \
+                    and not attributes['NAME'] in skip_towns:
+                x, y = record['geometry']['coordinates'][:2]
+                towns.append({
+                    'name': attributes['NAME'],
+                    'x': x,
+                    'y': y
+                })
+    return tuple(towns)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
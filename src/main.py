@@ -3,14 +3,15 @@ from datetime import datetime
 import argparse
 import xarray
 import utils
-import pandas
 import numpy
-import math
+import numba
 import multiprocessing
-import os
+import dask
 
 logging.basicConfig(level=logging.WARN, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d  %H:%M:%S")
 LOGGER = logging.getLogger(__name__)
+# Green dates are stored as int16 day indices. This value marks cells without a green date (cells without rain data).
+NO_GREEN_DATE = -1
 
 
 def main():
@@ -79,8 +80,7 @@ def get_options():
     )
     parser.add_argument(
         '--multiprocessing',
-        help='Number of processes to use in multiprocessing. Options: single, all_but_one, all. Defaults to '
-             'all_but_one.',
+        help='Number of worker threads to use. Options: single, all_but_one, all. Defaults to all_but_one.',
         choices=["single", "all_but_one", "all"],
         required=False,
         default="all_but_one",
@@ -100,10 +100,11 @@ def calc_green_date(options):
     Stores the result in results/green_date.nc
 
     :param options: Command line arguments obtained from get_options()
-    :return:
+    :return: Dataset containing the 70th percentile of Green Dates, so it can be used without reopening the saved file
     """
     # Open all files with rainfall data
-    daily_rain = xarray.open_mfdataset(options.daily_rain, combine='by_coords')
+    daily_rain = xarray.open_mfdataset(options.daily_rain, combine='by_coords', parallel=True,
+                                       chunks={'lat': 200, 'lon': 200})
     # Drop unnecessary variable
     daily_rain = daily_rain.drop_vars('crs', errors='ignore')
     daily_rain = daily_rain.rename({'lon': 'longitude', 'lat': 'latitude'})
@@ -111,107 +112,145 @@ def calc_green_date(options):
     start_date = options.start_date if options.start_date else daily_rain.time.values[0]
     end_date = options.end_date if options.end_date else daily_rain.time.values[-1]
     daily_rain = daily_rain.sel(time=slice(start_date, end_date))
+    # Each chunk holds the whole time series for a block of cells, so every block can be processed independently
+    daily_rain = daily_rain.chunk({'time': -1, 'latitude': 200, 'longitude': 200})
+    # Get name of variable to use for calculations (assume first variable)
+    var = list(daily_rain.keys())[0]
     # Date index used to split data into years with each year beginning on the 1st of September and ending on the 31st
     # of August
-    date_range = pandas.date_range(start_date, end_date)
-    my_years = xarray.DataArray([t.year if (t.month < 9) else (t.year + 1) for t in daily_rain.indexes['time']],
-                                dims='time', name='my_years', coords={'time': date_range})
-    year_idxs = daily_rain.groupby(my_years).groups
-
-    # Prepare jobs for multiprocessing. Each job receives 1 year of data, a copy of the options selected, and a filepath
-    # where it will temporarily store its result.
-    multiprocess_args = []
-    processed_files = []
-    for key, value in year_idxs.items():
-        temp_filepath = '{folder}/{year}.{pid}.temp'.format(folder=options.output, year=key, pid=os.getpid())
-        multiprocess_args.append((daily_rain.isel(time=value), options, temp_filepath))
-        processed_files.append(temp_filepath)
-
-    # Number of processes are selected via command line but default to the number of CPU cores available minus 1
+    dates = daily_rain.indexes['time']
+    my_years = dates.year.values + (dates.month.values >= 9)
+    # Days are sorted, so each year is a run of consecutive days. Years are given to the search as the index of their
+    # first day, followed by the end of the last year.
+    years, year_starts = numpy.unique(my_years, return_index=True)
+    year_bounds = numpy.append(year_starts, my_years.size)
+    # Rainfall is read as float32, which is enough for daily rain in mm and halves the memory used
+    daily_rain = daily_rain[var].astype(numpy.float32)
+    # Builds the green dates for each year lazily. Nothing is calculated until the percentile is taken below.
+    green_date_per_year = calc_green_date_per_year(daily_rain, year_bounds, options).assign_coords(my_years=years)
+
+    # Number of threads are selected via command line but default to the number of CPU cores available minus 1
     if options.multiprocessing == "single":
-        number_of_worker_processes = 1
+        number_of_workers = 1
     elif options.multiprocessing == "all":
-        number_of_worker_processes = multiprocessing.cpu_count()
+        number_of_workers = multiprocessing.cpu_count()
     else:
-        number_of_worker_processes = multiprocessing.cpu_count() - 1
-
-    pool = multiprocessing.Pool(number_of_worker_processes)
-    # Calls calc_green_date_for_year() with each process in the pool, using the arguments saved above
-    pool.map(calc_green_date_for_year, multiprocess_args)
-    pool.close()
-    pool.join()
-
-    # Open results for each year, which were temporarily stored. These contain the green dates for each year.
-    green_date_per_year = xarray.open_mfdataset(processed_files, combine='by_coords')
-    # Takes the green dates for each year and calculates the 70th percentile over all years.
-    percentile_green_date = green_date_per_year.reduce(numpy.nanpercentile, dim='time', q=70)
+        number_of_workers = multiprocessing.cpu_count() - 1
+
+    # Cells without a green date are only converted to nan here, right before the percentile is taken
+    green_date_per_year = green_date_per_year.astype(numpy.float32).where(green_date_per_year != NO_GREEN_DATE)
+    # Takes the green dates for each year and calculates the 70th percentile over all years. Every year of a block of
+    # cells is already in the same chunk, so the percentile is calculated one block at a time.
+    percentile_green_date = green_date_per_year.quantile(0.7, dim='my_years', skipna=True).drop_vars('quantile')\
+        .astype(numpy.float32)
+    percentile_green_date = percentile_green_date.to_dataset(name='green_dates')
+    description = 'Green Date, which is the first date after 1 September where there is historically a 70% chance of ' \
+                  'receiving at least {threshold}mm of rain over a maximum of {period} days.'\
+        .format(threshold=options.rain_threshold, period=options.period)
+    percentile_green_date.green_dates.attrs.update({'long_name': 'Green Date', 'description': description})
+
+    # Blocks are processed by dask's threaded scheduler. Each input file is read as a separate task, so a process pool
+    # would have to pickle every raw block of rain between processes. The search releases the GIL, so threads can run
+    # it in parallel. Calculated once here so the result can be both saved and returned.
+    with dask.config.set(scheduler='threads', num_workers=number_of_workers):
+        percentile_green_date = percentile_green_date.compute()
     output_path = '{folder}/green_date_{threshold}mm.nc'.format(folder=options.output, threshold=options.rain_threshold)
     utils.save_to_netcdf(percentile_green_date, output_path, logging_level=logging.INFO)
-    green_date_per_year.close()
-    # Removes all temporary files
-    for process in multiprocess_args:
-        temp_filepath = process[2]
-        os.remove(temp_filepath)
+    return percentile_green_date
 
 
-def calc_green_date_for_year(args):
+def calc_green_date_per_year(daily_rain, year_bounds, options):
     """
-    Calculates the green dates for a single year
+    Calculates the green dates for every year at once
 
-    :param args: Tuple containing the data to use for calculation, the command line arguments (options), and the path
-                 to save the results to
-    :return:
+    :param daily_rain: DataArray containing the daily rain for all years
+    :param year_bounds: Index of the first day of each year, followed by the number of days in daily_rain
+    :param options: Command line arguments obtained from get_options()
+    :return: Lazy DataArray of green dates with dimensions (latitude, longitude, my_years)
     """
-    # Unpack arguments
-    (dataset, options, temp_filepath) = args
-    # Get name of variable to use for calculations (assume first variable)
-    var = list(dataset.keys())[0]
-
-    # LOGGER.info('Daily rain:')
-    # LOGGER.info(dataset['daily_rain'].values[:, 400, 400])
-    # Calculate total rainfall over the period (command line argument, defaults to 3 days)
-    sum_over_x_days = dataset[var].rolling(
-        time=options.period,
-        min_periods=1
-    ).construct('window').sum('window', min_count=1).compute()
-    # LOGGER.info('3 Day Sum:')
-    # LOGGER.info(sum_3day.values[:, 400, 400])
-    # Set up empty array to be filled with green dates
-    green_dates = numpy.full(shape=(1, dataset.latitude.size, dataset.longitude.size), fill_value=numpy.nan, dtype=float)
-
-    # Iterate through lats, lon
-    for lat_i in range(sum_over_x_days.latitude.size):
-        for lon_i in range(sum_over_x_days.longitude.size):
-            # Iterate through time. The 1st occurrence of rainfall over the threshold (Ymm over X days, both command
-            # line arguments) is the green date. If rainfall is nan, it is assumed that rain doesn't cover this region
-            # and the cell is skipped. If the last day of the year is reached, the green date is assumed to be the max
-            # number of days in the year. Even though the final map only shows green dates up to 1st March, green dates
-            # all year round are calculated without shortcuts because they are needed to calculate an accurate
-            # percentile later on.
-            for time_i in range(sum_over_x_days.time.size):
-                value = sum_over_x_days.values[time_i, lat_i, lon_i]
-                if math.isnan(value):
-                    green_dates[0, lat_i, lon_i] = numpy.nan
-                    break
-                if value > options.rain_threshold:
-                    green_dates[0, lat_i, lon_i] = time_i
-                    break
-                if time_i == sum_over_x_days.time.size - 1:
-                    green_dates[0, lat_i, lon_i] = sum_over_x_days.time.size
-    # Insert results into a dataset to be saved
-    green_dates = xarray.Dataset(
-        {'green_dates': (['time', 'latitude', 'longitude'], green_dates)},
-        coords={
-            'time': [dataset.time.values[0].astype('datetime64[Y]')],
-            'latitude': dataset.latitude,
-            'longitude': dataset.longitude
-        }
+    # Runs the search on each block of cells in parallel. The time dimension is moved to the last axis of each block.
+    green_dates = xarray.apply_ufunc(
+        first_exceedance,
+        daily_rain,
+        kwargs={'year_bounds': year_bounds, 'period': options.period, 'threshold': options.rain_threshold},
+        input_core_dims=[['time']],
+        output_core_dims=[['my_years']],
+        dask='parallelized',
+        output_dtypes=[numpy.int16],
+        dask_gufunc_kwargs={'output_sizes': {'my_years': year_bounds.size - 1}}
     )
-    description = 'Green Date, which is the first date after 1 September where there is historically a 70% chance of ' \
-                  'receiving at least {threshold}mm of rain over a maximum of {period} days.'\
-        .format(threshold=options.rain_threshold, period=options.period)
-    green_dates.green_dates.assign_attrs({'long_name': 'Green Date', 'description': description})
-    utils.save_to_netcdf(green_dates, temp_filepath)
+    return green_dates.rename('green_dates')
+
+
+# Releases the GIL so dask's threads can search several blocks at once
+@numba.njit(nogil=True, cache=True)
+def first_exceedance(daily_rain, year_bounds, period, threshold):
+    """
+    Finds the green date (first day of the year where total rainfall over the period is over the threshold) for each
+    cell and year. Nan days are left out of totals and totals don't carry over between years. Cells that reach a period
+    of only nan days before the threshold get NO_GREEN_DATE, and cells that never reach the threshold get the number of
+    days in the year.
+
+    :param daily_rain: Array of daily rain with dimensions (latitude, longitude, time)
+    :param year_bounds: Index of the first day of each year, followed by the number of days in daily_rain
+    :param period: The number of days to total rainfall over
+    :param threshold: The rainfall threshold for Green Date conditions to be considered met
+    :return: Array of green dates with dimensions (latitude, longitude, year), as int16
+    """
+    lat_size, lon_size = daily_rain.shape[:2]
+    year_size = year_bounds.size - 1
+    green_dates = numpy.full((lat_size, lon_size, year_size), NO_GREEN_DATE, dtype=numpy.int16)
+    # Running total of the days in the window for each cell in a row, the number of those days with rainfall data, and
+    # the longitude index of each cell still being searched
+    total = numpy.zeros(lon_size)
+    days_with_data = numpy.zeros(lon_size, dtype=numpy.int64)
+    cells = numpy.zeros(lon_size, dtype=numpy.int64)
+    # Blocks are stored with longitude changing fastest, so a row of cells is searched one day at a time to read rain in
+    # the order it is stored
+    for lat_i in range(lat_size):
+        for year_i in range(year_size):
+            year_start = year_bounds[year_i]
+            year_end = year_bounds[year_i + 1]
+            # Cells with no rainfall data on the first day of the year (such as the ocean) have no green date, so only
+            # land cells are searched
+            cells_searching = 0
+            for lon_i in range(lon_size):
+                if not numpy.isnan(daily_rain[lat_i, lon_i, year_start]):
+                    total[lon_i] = 0.0
+                    days_with_data[lon_i] = 0
+                    cells[cells_searching] = lon_i
+                    cells_searching += 1
+            for time_i in range(year_start, year_end):
+                # Stop once every cell in the row has been found
+                if cells_searching == 0:
+                    break
+                # Cells that are found are removed from the list, so the rest of the year only reads cells still being
+                # searched
+                cells_kept = 0
+                for cell_i in range(cells_searching):
+                    lon_i = cells[cell_i]
+                    value = daily_rain[lat_i, lon_i, time_i]
+                    if not numpy.isnan(value):
+                        total[lon_i] += value
+                        days_with_data[lon_i] += 1
+                    # The total is kept as a running total: add the new day and remove the day that has left the window
+                    if time_i - period >= year_start:
+                        old_value = daily_rain[lat_i, lon_i, time_i - period]
+                        if not numpy.isnan(old_value):
+                            total[lon_i] -= old_value
+                            days_with_data[lon_i] -= 1
+                    if days_with_data[lon_i] == 0:
+                        continue
+                    if total[lon_i] > threshold:
+                        green_dates[lat_i, lon_i, year_i] = time_i - year_start
+                        continue
+                    cells[cells_kept] = lon_i
+                    cells_kept += 1
+                cells_searching = cells_kept
+            # Cells still being searched at the end of the year never reached the threshold
+            for cell_i in range(cells_searching):
+                green_dates[lat_i, cells[cell_i], year_i] = year_end - year_start
+    return green_dates
 
 
 if __name__ == '__main__':
@@ -18,8 +18,8 @@ def main():
     start_time = datetime.now()
     LOGGER.info('Starting time: ' + str(start_time))
 
-    regrid_clay_content(options)
-    splice_maps(options)
+    clay_content = regrid_clay_content(options)
+    splice_maps(options, clay_content)
 
     end_time = datetime.now()
     LOGGER.info('End time: ' + str(end_time))
@@ -62,6 +62,11 @@ def get_options():
         help='The path to save the combined Green Date results at.',
         default='results/green_date_soil.nc'
     )
+    parser.add_argument(
+        '--emit_clay_temp',
+        help='Also save the regridded clay content to results/clay_content_temp.nc, for debugging.',
+        action='store_true'
+    )
     args = parser.parse_args()
     return args
 
@@ -75,40 +80,33 @@ def regrid_clay_content(options):
     clay_content['latitude'].attrs['axis'] = 'Y'
     clay_content['longitude'].attrs['units'] = 'degrees_east'
     clay_content['longitude'].attrs['axis'] = 'X'
-    utils.save_to_netcdf(clay_content, 'results/clay_content_temp.nc')
+    # The regridded clay content is passed straight to splice_maps(), so it is only saved when asked for
+    if options.emit_clay_temp:
+        utils.save_to_netcdf(clay_content, 'results/clay_content_temp.nc')
+    return clay_content
+
 
+def splice_maps(options, clay_content):
+    clay = clay_content.clay_content_percentage.values
+
+    green_dates = []
+    for threshold in ['10', '20', '30', '40', '50']:
+        with xarray.open_dataset(options.green_date_files.format(threshold=threshold)) as green_date:
+            green_dates.append(green_date.green_dates.values)
+
+    # Each Green Date file is used for a range of clay content: under 20%, 20-30%, 30-35%, 35-45% and 45% or more. The
+    # range of each cell is found once and used to pick from the files in one pass. Cells without clay content are
+    # left as nan.
+    clay_range = numpy.digitize(clay, [20, 30, 35, 45])
+    green_date = numpy.where(numpy.isnan(clay), numpy.nan, numpy.choose(clay_range, green_dates))
 
-def splice_maps(options):
     # Set up new dataset to hold result
     latitude = numpy.arange(-44.0, -9.975, 0.05)
     longitude = numpy.arange(112.0, 154.025, 0.05)
     green_date_spliced = xarray.Dataset(
-        data_vars={'green_date': (['latitude', 'longitude'], numpy.full([len(latitude), len(longitude)], numpy.nan))},
+        data_vars={'green_date': (['latitude', 'longitude'], green_date)},
         coords={'latitude': latitude, 'longitude': longitude}
     )
-
-    clay_content = xarray.open_dataset('results/clay_content_temp.nc')
-
-    with xarray.open_dataset(options.green_date_files.format(threshold='10')) as green_date_10:
-        index = clay_content.clay_content_percentage < 20
-        green_date_spliced.green_date.values[index] = green_date_10.green_dates.values[index]
-
-    with xarray.open_dataset(options.green_date_files.format(threshold='20')) as green_date_20:
-        index = numpy.logical_and(clay_content.clay_content_percentage >= 20, clay_content.clay_content_percentage < 30)
-        green_date_spliced.green_date.values[index] = green_date_20.green_dates.values[index]
-
-    with xarray.open_dataset(options.green_date_files.format(threshold='30')) as green_date_30:
-        index = numpy.logical_and(clay_content.clay_content_percentage >= 30, clay_content.clay_content_percentage < 35)
-        green_date_spliced.green_date.values[index] = green_date_30.green_dates.values[index]
-
-    with xarray.open_dataset(options.green_date_files.format(threshold='40')) as green_date_40:
-        index = numpy.logical_and(clay_content.clay_content_percentage >= 35, clay_content.clay_content_percentage < 45)
-        green_date_spliced.green_date.values[index] = green_date_40.green_dates.values[index]
-
-    with xarray.open_dataset(options.green_date_files.format(threshold='50')) as green_date_50:
-        index = clay_content.clay_content_percentage >= 45
-        green_date_spliced.green_date.values[index] = green_date_50.green_dates.values[index]
-
     utils.save_to_netcdf(green_date_spliced, 'results/green_date_soil_combined.nc')
 
 
@@ -20,8 +20,10 @@ def save_to_netcdf(dataset, path, encoding=None, logging_level=logging.WARN):
             os.makedirs(os.path.dirname(path), exist_ok=True)
         if encoding is None:
             encoding = {}
+        # Compress every variable at the lowest level, which saves most of the space for much less time spent writing.
+        # Any encoding given for a variable is kept.
         for key in dataset.keys():
-            encoding[key] = {'zlib': True}
+            encoding[key] = {'zlib': True, 'complevel': 1, **encoding.get(key, {})}
         delayed_obj = dataset.to_netcdf(path, compute=False, format='NETCDF4', engine='netcdf4', unlimited_dims='time',
                                         encoding=encoding)
         # Write this to log instead of stdout